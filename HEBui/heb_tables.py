@@ -0,0 +1,164 @@
+"""Scenario result tables: runtime PV subtraction and serialization.
+
+Kept apart from the app script so that export worker processes only import this module.
+"""
+
+import io
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+input_data_path = Path('../input_data')
+
+# onsite PV yield in kWh per m2 floor area and year (GWh per million m2),
+# by building type (BTID); rough EU-average rooftop estimates
+PV_YIELD_DEFAULTS = {
+    1: 10.0,  # EDUC
+    2: 8.0,   # HORES
+    3: 6.0,   # HOSP
+    4: 8.0,   # OTHER
+    5: 12.0,  # RETAIL
+    6: 8.0,   # OFFICE
+    7: 20.0,  # SF
+    8: 8.0,   # MF
+    9: 0.0,   # SLUM
+}
+# model building codes (BID, PBID) of the result tables; PBID splits the commercial BID 2
+BUILDING_TYPES = {
+    (1, 0): 7,  # SF
+    (2, 1): 1,  # EDUC
+    (2, 2): 2,  # HORES
+    (2, 3): 3,  # HOSP
+    (2, 4): 4,  # OTHER
+    (2, 5): 5,  # RETAIL
+    (2, 6): 6,  # OFFICE
+    (3, 0): 8,  # MF
+    (4, 0): 9,  # SLUM
+}
+# country specific values (columns: LID, BTID, yield) override the defaults
+pv_yield_path = Path('data/pv_yield.csv')
+PV_YIELD = {}
+if pv_yield_path.exists():
+    PV_YIELD = pd.read_csv(pv_yield_path).set_index(['LID', 'BTID'])['yield'].to_dict()
+
+VINTAGE_COLUMNS = ['st', 'ret', 'aret', 'new', 'anew']
+
+RESULT_TARGETS = {
+    'floor_area': '_floor_area',
+    'energy': '_energy',
+    'emissions': '_emissions',
+}
+
+FUEL_SPLIT = None
+FUEL_SPLIT_FILES = ['FuelSplit.csv', 'FuelSplitHotWater.csv', 'CO2EmissionFactors.csv']
+
+
+def electricity_shares(fuel_split, factors):
+    fuel_emissions = fuel_split * factors
+    return fuel_split['elec'], fuel_emissions['elec'] / fuel_emissions.sum(axis='columns')
+
+
+def load_fuel_split():
+    """Electricity shares of the country fuel splits, or None if the input data is missing."""
+    global FUEL_SPLIT
+    if FUEL_SPLIT is None:
+        if not all((input_data_path / filename).exists() for filename in FUEL_SPLIT_FILES):
+            return None
+        factors = pd.read_csv(input_data_path / 'CO2EmissionFactors.csv', encoding='utf-8-sig', index_col='LID')
+        fuel_split = pd.read_csv(input_data_path / 'FuelSplit.csv', encoding='utf-8-sig', index_col='LID')
+        fuel_split = fuel_split[factors.columns]
+        # the first of the hot water fuel mixes (columns suffixed 1)
+        hot_water = pd.read_csv(input_data_path / 'FuelSplitHotWater.csv', encoding='utf-8-sig', index_col='LID')
+        hot_water = hot_water[[fuel + '1' for fuel in factors.columns]].set_axis(factors.columns, axis='columns')
+        elec, elec_emissions = electricity_shares(fuel_split, factors)
+        hw_elec, hw_elec_emissions = electricity_shares(hot_water, factors)
+        FUEL_SPLIT = pd.DataFrame({
+            'elec': elec,
+            'elec_emissions': elec_emissions,
+            'hw_elec': hw_elec,
+            'hw_elec_emissions': hw_elec_emissions,
+        }).fillna(0)
+    return FUEL_SPLIT
+
+
+def building_types(index):
+    if 'BTID' in index.names:
+        return index.get_level_values('BTID')
+    if 'BID' not in index.names or 'PBID' not in index.names:
+        raise ValueError('PV yield needs a BTID or BID and PBID index level, got {}'.format(index.names))
+    codes = pd.MultiIndex.from_arrays([index.get_level_values('BID'), index.get_level_values('PBID')])
+    btids = codes.map(BUILDING_TYPES)
+    unknown = codes[btids.isna()].unique()
+    if len(unknown) > 0:
+        raise ValueError('Unknown building codes (BID, PBID): {}'.format(list(unknown)))
+    return btids.astype(int)
+
+
+def pv_yield(index):
+    lids = index.get_level_values('LID')
+    btids = building_types(index)
+    yields = btids.map(PV_YIELD_DEFAULTS).to_numpy(dtype=float)
+    if PV_YIELD:
+        overrides = pd.MultiIndex.from_arrays([lids, btids]).map(PV_YIELD).to_numpy(dtype=float)
+        yields = np.where(np.isnan(overrides), yields, overrides)
+    return pd.Series(np.nan_to_num(yields), index=index)
+
+
+def enduse_shares(data_frame, share):
+    # share of electricity (or of electricity's emissions) in each column's end-use;
+    # cooling is all electric, hot water follows the country's hot water fuel split,
+    # the other end-uses its space heating fuel split
+    fuel_split = load_fuel_split()
+    lids = data_frame.index.get_level_values('LID')
+    lid_shares = fuel_split[share].reindex(lids).fillna(0).to_numpy()
+    hw_shares = fuel_split['hw_' + share].reindex(lids).fillna(0).to_numpy()
+    enduses = data_frame.columns.get_level_values(0)
+    shares = np.repeat(lid_shares[:, np.newaxis], len(enduses), axis=1)
+    hot_water = np.asarray(enduses == 'hot_water')
+    shares[:, hot_water] = hw_shares[:, np.newaxis]
+    shares[:, np.asarray(enduses == 'cooling')] = 1.0
+    return shares
+
+
+def pv_offset_ratio(scenario):
+    """Share of the gross electricity demand covered by onsite PV, per row."""
+    energy = scenario['_energy']
+    floor_area = scenario['_floor_area'].reindex(energy.index)[VINTAGE_COLUMNS].sum(axis='columns')
+    production = pv_yield(energy.index) * floor_area.fillna(0)
+    electricity = (energy.to_numpy() * enduse_shares(energy, 'elec')).sum(axis=1)
+    offset = np.minimum(production.to_numpy(), electricity)
+    ratio = np.divide(offset, electricity, out=np.zeros_like(electricity), where=electricity > 0)
+    return pd.Series(ratio, index=energy.index)
+
+
+def subtract_pv(scenario, target):
+    data_frame = scenario[RESULT_TARGETS[target]]
+    ratio = pv_offset_ratio(scenario).reindex(data_frame.index).fillna(0).to_numpy()
+    share = 'elec' if target == 'energy' else 'elec_emissions'
+    return data_frame * (1 - ratio[:, np.newaxis] * enduse_shares(data_frame, share))
+
+
+def scenario_table(scenario, target, pv):
+    if pv:
+        return subtract_pv(scenario, target)
+    return scenario[RESULT_TARGETS[target]]
+
+
+def serialize_result_table(data_frame, file_format):
+    if file_format == 'parquet':
+        # parquet only accepts flat, string column names
+        if isinstance(data_frame.columns, pd.MultiIndex):
+            columns = ['_'.join(str(level) for level in column) for column in data_frame.columns]
+        else:
+            columns = [str(column) for column in data_frame.columns]
+        buffer = io.BytesIO()
+        data_frame.set_axis(columns, axis='columns').to_parquet(buffer)
+        return buffer.getvalue()
+    return data_frame.to_csv().encode('utf-8')
+
+
+def export_result_table(tables, target, pv, file_format):
+    # runs in an export worker process
+    data_frame = scenario_table(tables, target, pv)
+    return serialize_result_table(data_frame, file_format), len(data_frame)
@@ -10,6 +10,15 @@ import ast
 import copy
 import re
 import sys
+import hashlib
+import importlib.util
+import json
+import os
+import zipfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 
 from dash import Dash, dcc, html, Input, Output, State, MATCH, ALL
 from dash import callback_context
@@ -18,6 +27,9 @@ import dash_bootstrap_components as dbc
 import plotly.express as px
 import pandas as pd
 
+from heb_tables import (input_data_path, pv_yield_path, VINTAGE_COLUMNS, RESULT_TARGETS,
+                        load_fuel_split, scenario_table, export_result_table)
+
 px.defaults.template = 'simple_white'
 
 app = Dash(__name__, external_stylesheets=[
@@ -41,6 +53,16 @@ if vin_path.exists():
     with vin_path.open(mode='rb') as vin_file:
         VINTAGE = pickle.load(vin_file)
 
+# parquet export needs one of the optional pandas parquet engines
+PARQUET_AVAILABLE = any(importlib.util.find_spec(engine) is not None
+                        for engine in ('pyarrow', 'fastparquet'))
+EXPORT_WORKERS = min(8, os.cpu_count() or 1)
+EXPORT_POOL = None
+export_pool_lock = threading.Lock()
+
+# setups rendered directly on the Calculate page, the rest is loaded when scrolled into view
+CALCULATE_EAGER_ROWS = 10
+
 def store_setups():
     with setups_path.open(mode='wb') as setups_file:
         pickle.dump(SETUPS, setups_file)
@@ -69,10 +91,192 @@ RESULTS = {}
 """
 RESULTS[setup_name]{
     'scenarios':
-        [sid]: heb.Scenario
+        [sid]: heb.Scenario,
+    'sources':
+        [sid]: str (path of the loaded scenario file)
 }
 """
 
+FILE_HASHES = {}
+
+LAYOUT_CACHE = {}
+LAYOUT_VERSIONS = {}
+layout_lock = threading.Lock()
+
+
+def invalidate_layouts(setup_name):
+    """Drop the memoized layout fragments of a setup after its SETUPS or RESULTS entry changed."""
+    with layout_lock:
+        LAYOUT_VERSIONS[setup_name] = LAYOUT_VERSIONS.get(setup_name, 0) + 1
+        for key in [key for key in LAYOUT_CACHE if key[1] == setup_name]:
+            del LAYOUT_CACHE[key]
+
+
+def cached_layout(fragment, setup_name, render, *args):
+    with layout_lock:
+        version = LAYOUT_VERSIONS.get(setup_name, 0)
+        key = (fragment, setup_name, version) + args
+        if key in LAYOUT_CACHE:
+            return LAYOUT_CACHE[key]
+
+    # render outside the lock, the server handles requests in threads
+    layout = render(setup_name, *args)
+
+    with layout_lock:
+        # a render that raced an invalidation is served once but not stored
+        if LAYOUT_VERSIONS.get(setup_name, 0) == version:
+            for stale in [stale for stale in LAYOUT_CACHE if stale[1] == setup_name and stale[2] < version]:
+                del LAYOUT_CACHE[stale]
+            LAYOUT_CACHE[key] = layout
+    return layout
+
+
+def result_pv(setup_name, sid, target):
+    # without the fuel split input data PV is left unapplied
+    return (target != 'floor_area' and SETUPS[setup_name]['scenarios'][sid]['pv']
+            and load_fuel_split() is not None)
+
+
+def result_table(setup_name, sid, target):
+    scenario = RESULTS[setup_name]['scenarios'][sid]
+    return scenario_table(scenario, target, result_pv(setup_name, sid, target))
+
+
+def result_filename(setup_name, sid, target, extension='csv'):
+    scenario = RESULTS[setup_name]['scenarios'][sid]
+    return table_filename(setup_name, scenario['name'], target, result_pv(setup_name, sid, target), extension)
+
+
+def table_filename(setup_name, scenario_name, target, pv, extension='csv'):
+    this_pv = ''
+    if pv:
+        this_pv = '-pv'
+    scen_name = re.sub(r'[^\w\-_\.]', '_', str(scenario_name))
+    return 'HEB_{stp}_{t}{pv}_{scen}.{ext}'.format(stp = setup_name, t = target, pv = this_pv,
+                                                  scen = scen_name, ext = extension)
+
+
+def export_pool():
+    # to_csv holds the GIL, so the tables are serialized in worker processes;
+    # spawn keeps the workers clear of the threaded web server's state.
+    # The workers only run heb_tables, but spawn still re-imports this script
+    # (as __mp_main__) in each of them once, when the pool starts; the pool is
+    # kept for the lifetime of the server, so that start-up cost is paid once.
+    global EXPORT_POOL
+    with export_pool_lock:
+        if EXPORT_POOL is None:
+            EXPORT_POOL = ProcessPoolExecutor(max_workers=EXPORT_WORKERS,
+                                              mp_context=multiprocessing.get_context('spawn'))
+        return EXPORT_POOL
+
+
+def reset_export_pool(pool):
+    # a dead worker breaks the whole executor; the next export starts a new one
+    global EXPORT_POOL
+    with export_pool_lock:
+        if EXPORT_POOL is pool:
+            EXPORT_POOL = None
+    pool.shutdown(wait=False)
+
+
+def file_sha256(path):
+    stat = path.stat()
+    key = (str(path.resolve()), stat.st_mtime_ns, stat.st_size)
+    if key not in FILE_HASHES:
+        digest = hashlib.sha256()
+        with path.open(mode='rb') as hashed_file:
+            for chunk in iter(lambda: hashed_file.read(1 << 20), b''):
+                digest.update(chunk)
+        FILE_HASHES[key] = digest.hexdigest()
+    return FILE_HASHES[key]
+
+
+def input_data_hashes(setup_name, results):
+    hashes = {}
+    for csv_path in sorted(input_data_path.glob('*.csv')):
+        hashes['input_data/' + csv_path.name] = file_sha256(csv_path)
+    for table, csv in SETUPS[setup_name].get('input_csvs', {}).items():
+        hashes['setup/' + csv['filename']] = hashlib.sha256(csv['df_data'].encode('utf-8')).hexdigest()
+    if pv_yield_path.exists():
+        hashes[pv_yield_path.as_posix()] = file_sha256(pv_yield_path)
+    for sid, source in results.get('sources', {}).items():
+        source_path = Path(source)
+        if source_path.is_file():
+            hashes[source_path.as_posix()] = file_sha256(source_path)
+    return hashes
+
+
+def build_result_archive(setup_name, file_format):
+    """Serialize every scenario table of a setup in parallel into one zip archive."""
+    pool = export_pool()
+    try:
+        return write_result_archive(setup_name, file_format, pool)
+    except BrokenProcessPool:
+        # retry once on a fresh pool, a second failure is raised
+        reset_export_pool(pool)
+        return write_result_archive(setup_name, file_format, export_pool())
+
+
+def write_result_archive(setup_name, file_format, pool):
+    setup = SETUPS[setup_name]
+    # a concurrent delete or PV toggle must not change the tables mid-export
+    results = RESULTS[setup_name]
+    scenarios = results['scenarios']
+    extension = 'parquet' if file_format == 'parquet' else 'csv'
+    tasks = [(sid, target) for sid in scenarios for target in RESULT_TARGETS]
+    order = {task: i for i, task in enumerate(tasks)}
+    tables = []
+
+    buffer = io.BytesIO()
+    # parquet files are already compressed; level 1 deflate is several times faster
+    # than to_csv, so compressing finished tables overlaps with the running workers
+    compression = zipfile.ZIP_STORED if extension == 'parquet' else zipfile.ZIP_DEFLATED
+    with zipfile.ZipFile(buffer, mode='w', compression=compression, compresslevel=1) as archive:
+        futures = {}
+        for sid, target in tasks:
+            scenario = scenarios[sid]
+            pv = result_pv(setup_name, sid, target)
+            # only ship the tables the worker needs
+            keys = {RESULT_TARGETS[target]}
+            if pv:
+                keys |= {'_energy', '_floor_area'}
+            worker_tables = {key: scenario[key] for key in keys}
+            future = pool.submit(export_result_table, worker_tables, target, pv, file_format)
+            futures[future] = (sid, target, pv)
+
+        # write each table as soon as its worker finishes
+        for future in as_completed(futures):
+            sid, target, pv = futures[future]
+            payload, rows = future.result()
+            # the scenario id keeps members of equally named scenarios apart
+            filename = 'scenario_{sid}/{name}'.format(
+                sid = sid, name = table_filename(setup_name, scenarios[sid]['name'], target, pv, extension))
+            archive.writestr(filename, payload)
+            tables.append({
+                'file': filename,
+                'scenario_id': sid,
+                'scenario': str(scenarios[sid]['name']),
+                'target': target,
+                'pv': pv,
+                'rows': rows,
+                'sha256': hashlib.sha256(payload).hexdigest(),
+            })
+
+        tables.sort(key=lambda table: order[(table['scenario_id'], table['target'])])
+        manifest = {
+            'setup': setup_name,
+            'start_year': setup['start_year'],
+            'end_year': setup['end_year'],
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'format': extension,
+            'tables': tables,
+            'input_data': input_data_hashes(setup_name, results),
+        }
+        archive.writestr('manifest.json', json.dumps(manifest, indent=2))
+
+    filename = 'HEB_{stp}_results_{ext}.zip'.format(stp = setup_name, ext = extension)
+    return buffer.getvalue(), filename
+
 # ICONS
 chevron_right = html.I(className="bi bi-chevron-compact-right text-secondary")
 spreadsheet_icon = html.I(className="bi bi-file-earmark-spreadsheet text-success h2")
@@ -279,6 +483,25 @@ def render_output_rows(setup_name):
         ], align="center")
         for sid in setup['scenarios']
     ]
+    rows.append(
+        dbc.Row([
+            dbc.Col(html.B('All scenarios'), width=2),
+            dbc.Col(dbc.RadioItems(
+                options=[
+                    {'label': 'CSV', 'value': 'csv'},
+                    {'label': 'Parquet', 'value': 'parquet', 'disabled': not PARQUET_AVAILABLE},
+                ],
+                value='csv',
+                inline=True,
+                id={'type': 'download-all-format', 'index': setup_name},
+            ), width=2),
+            dbc.Col([html.Span('Archive (ZIP)'),
+                     dbc.Button(download_icon, color='link', size='md', className='m-1',
+                                id={'type': 'download-all-button', 'index': setup_name}),
+                     dcc.Download(id={'type': 'download-all-zip', 'index': setup_name}),
+                     ], width=2),
+        ], align="center")
+    )
     return rows
 
 
@@ -287,7 +510,7 @@ def render_calculate_row(setup_name):
     setup = SETUPS[setup_name]
 
     if setup_name in RESULTS:
-        outputs = render_output_rows(setup_name)
+        outputs = cached_layout('output_rows', setup_name, render_output_rows)
         button_outline = True
         button_color = 'secondary'
         button_disabled = True
@@ -326,10 +549,38 @@ def render_calculate_row(setup_name):
     return row
 
 
-def render_calculate():
-    content = [render_header('calculate')] + [
-        render_calculate_row(setup) for setup in SETUPS
-    ]
+def render_calculate_placeholder(setup_name):
+    # the spinner wraps the callback target, so it shows while the row is loading
+    placeholder = dbc.Spinner(html.Div([
+        html.H4('Setup: ' + SETUPS[setup_name]['name']),
+        html.Div(style={'minHeight': '4rem'}),
+        html.Button(id={'type': 'calculate-row-loader', 'index': setup_name},
+                    n_clicks=0, hidden=True),
+        html.Hr()
+    ], id={'type': 'calculate-row', 'index': setup_name}))
+    return placeholder
+
+
+def render_calculate(eager_rows=CALCULATE_EAGER_ROWS):
+    rows = []
+    for i, setup in enumerate(SETUPS):
+        if i < eager_rows:
+            rows.append(cached_layout('calculate_row', setup, render_calculate_row))
+        else:
+            rows.append(render_calculate_placeholder(setup))
+    content = [render_header('calculate')] + rows
+    return content
+
+
+def render_calculate_validation():
+    # placeholders plus one fully rendered setup, so every Calculate component id is present
+    content = render_calculate(eager_rows=0)
+    setup_name = next((setup for setup in SETUPS if 'scenarios' in SETUPS[setup]), None)
+    if setup_name is not None:
+        content += [
+            cached_layout('calculate_row', setup_name, render_calculate_row),
+            html.Div(cached_layout('output_rows', setup_name, render_output_rows)),
+        ]
     return content
 
 
@@ -337,7 +588,7 @@ def create_floor_area_figure(setup_name, sid):
     scenario = RESULTS[setup_name]['scenarios'][sid]
     floor_area = scenario['_floor_area']
     floor_area = floor_area.groupby('Year').sum() / 1e3
-    plot_data = floor_area[['st', 'ret', 'aret', 'new', 'anew']]
+    plot_data = floor_area[VINTAGE_COLUMNS]
     plot_data = plot_data.rename(columns=VINTAGE)
     figure = px.area(
         plot_data,
@@ -379,7 +630,7 @@ def create_energy_figure(setup_name, enduses):
     if len(RESULTS) < 1:
         return None
     scenarios = RESULTS[setup_name]['scenarios']
-    energy_dfs = {scen['name']: scen['_energy'] for id, scen in scenarios.items()}
+    energy_dfs = {scen['name']: result_table(setup_name, sid, 'energy') for sid, scen in scenarios.items()}
     energy = pd.concat(energy_dfs, axis='columns')
     energy = energy.groupby('Year').sum() / 1e6
     energy = energy.sum(axis='columns', level=[1, 0])
@@ -471,7 +722,7 @@ app.validation_layout = html.Div([
     dbc.Container(id='page-content'),
     render_welcome(),
     render_scenarios(),
-    render_calculate(),
+    render_calculate_validation(),
     render_visualize(),
 ])
 
@@ -548,14 +799,15 @@ def save_scenario_names(n_save, names, pvs, setup_name):
         scen_indices = [sn['id']['index'] for sn in ctx.states_list[0]]
         pv_bools = [True if len(pv) == 1 else False for pv in pvs]
         scen_dict = {sid: {'id': sid, 'name': name, 'pv': pv} for sid, name, pv in zip(scen_indices, names, pv_bools)}
-        if 'scenarios' in SETUPS[setup_name]:
-            if SETUPS[setup_name]['scenarios'] == scen_dict:
-                return None
+        old_scenarios = SETUPS[setup_name].get('scenarios', {})
+        if old_scenarios == scen_dict:
+            return None
         SETUPS[setup_name]['scenarios'] = scen_dict
         store_setups()
-        rk = list(RESULTS.keys())
-        for r in rk:
-            del RESULTS[r]
+        # PV toggles are applied on the cached gross results, only new scenarios need reloading
+        if setup_name in RESULTS and set(old_scenarios) != set(scen_dict):
+            del RESULTS[setup_name]
+        invalidate_layouts(setup_name)
         return dbc.Alert('Scenarios saved', color='success', dismissable=True, duration=3000)
 
 
@@ -585,28 +837,27 @@ def calculate_outputs(n_calc, c_del):
     if trigger_type == 'calc-button':
         try:
             setup = SETUPS[trigger_setup]
-            results = {'scenarios': {}}
+            results = {'scenarios': {}, 'sources': {}}
 
             for sid in setup['scenarios']:
                 scen_name = setup['scenarios'][sid]['name']
-                pvint = 0
-                pv = setup['scenarios'][sid]['pv']
-                if pv:
-                    pvint = 1
                 start_year = setup['start_year']
                 end_year = setup['end_year']
 
-                scen_path = Path('data/scen_{s}_{yb}_{ye}_{pv}.pbz2'.format(s = sid, yb = start_year, ye = end_year, pv = pvint))
+                # gross results only, PV is subtracted at runtime (see result_table)
+                scen_path = Path('data/scen_{s}_{yb}_{ye}_0.pbz2'.format(s = sid, yb = start_year, ye = end_year))
 
                 if scen_path.is_file():
                     with bz2.BZ2File(scen_path,'rb') as scen_file:
                         scenario = pickle.load(scen_file)
 
                 results['scenarios'][sid] = scenario
+                results['sources'][sid] = str(scen_path)
 
             RESULTS[trigger_setup] = results
+            invalidate_layouts(trigger_setup)
             success = True
-            output = render_output_rows(trigger_setup)
+            output = cached_layout('output_rows', trigger_setup, render_output_rows)
         except Exception as error:
             import traceback
             success = False
@@ -621,6 +872,7 @@ def calculate_outputs(n_calc, c_del):
 
     elif trigger_type == 'del-results-button':
         del RESULTS[trigger_setup]
+        invalidate_layouts(trigger_setup)
         success = False
         output = dbc.Alert('Results have been deleted', color='danger', dismissable=True)
 
@@ -640,6 +892,44 @@ def calculate_outputs(n_calc, c_del):
     return output, button_outline, button_color, button_disabled, del_icon, del_disabled
 
 
+# click the hidden loader of a lazy setup row once the row scrolls into view
+app.clientside_callback(
+    """
+    function(id) {
+        setTimeout(function() {
+            var element = document.getElementById(JSON.stringify(id, Object.keys(id).sort()));
+            if (!element) {
+                return;
+            }
+            var observer = new IntersectionObserver(function(entries) {
+                if (entries.some(function(entry) { return entry.isIntersecting; })) {
+                    observer.disconnect();
+                    element.click();
+                }
+            }, {rootMargin: '200px'});
+            observer.observe(element.parentElement);
+        }, 0);
+        return window.dash_clientside.no_update;
+    }
+    """,
+    Output({'type': 'calculate-row-loader', 'index': MATCH}, 'title'),
+    Input({'type': 'calculate-row-loader', 'index': MATCH}, 'id')
+)
+
+
+@app.callback(
+    Output({'type': 'calculate-row', 'index': MATCH}, 'children'),
+    Input({'type': 'calculate-row-loader', 'index': MATCH}, 'n_clicks'),
+    State({'type': 'calculate-row-loader', 'index': MATCH}, 'id'),
+    prevent_initial_call=True
+)
+def load_calculate_row(n_load, trigger_id):
+    setup_name = trigger_id['index']
+    if setup_name not in SETUPS:
+        raise PreventUpdate
+    return cached_layout('calculate_row', setup_name, render_calculate_row)
+
+
 @app.callback(
     Output({'type': 'download-result-csv', 'target': MATCH, 'index': MATCH, 'sid': MATCH}, 'data'),
     Input({'type': 'result_download-button', 'target': MATCH, 'index': MATCH, 'sid': MATCH}, 'n_clicks'),
@@ -650,27 +940,35 @@ def download_result_table(n_download, trigger_id):
     target = trigger_id['target']
     setup_name = trigger_id['index']
     sid = trigger_id['sid']
-    scenario = RESULTS[setup_name]['scenarios'][sid]
-    this_pv = ''
-    if SETUPS['default']['scenarios'][sid]['pv']:
-        this_pv = '-pv'
-    scen_name = re.sub(r'[^\w\-_\.]', '_', str(scenario['name']))
-
-    if target == 'floor_area':
-        data_frame = scenario['_floor_area']
-        this_pv = ''
-    elif target == 'energy':
-        data_frame = scenario['_energy']
-    elif target == 'emissions':
-        data_frame = scenario['_emissions']
-    else:
+
+    if target not in RESULT_TARGETS:
         return None
 
-    filename = 'HEB_{stp}_{t}{pv}_{scen}.csv'.format(stp = setup_name, t = target, pv = this_pv, scen = scen_name)
+    data_frame = result_table(setup_name, sid, target)
+    filename = result_filename(setup_name, sid, target)
 
     return dcc.send_data_frame(data_frame.to_csv, filename)
 
 
+@app.callback(
+    Output({'type': 'download-all-zip', 'index': MATCH}, 'data'),
+    Input({'type': 'download-all-button', 'index': MATCH}, 'n_clicks'),
+    State({'type': 'download-all-format', 'index': MATCH}, 'value'),
+    State({'type': 'download-all-button', 'index': MATCH}, 'id'),
+    prevent_initial_call=True
+)
+def download_all_results(n_download, file_format, trigger_id):
+    setup_name = trigger_id['index']
+    if setup_name not in RESULTS:
+        raise PreventUpdate
+    if file_format == 'parquet' and not PARQUET_AVAILABLE:
+        file_format = 'csv'
+
+    content, filename = build_result_archive(setup_name, file_format)
+
+    return dcc.send_bytes(content, filename)
+
+
 # Visualize callbacks
 @app.callback(
     Output('floor_area_figure_layout', 'children'),
@@ -678,8 +976,8 @@ def download_result_table(n_download, trigger_id):
     Input('visualize-setup-dropdown', 'value')
 )
 def floor_area_layout(setup_name):
-    floor_area_fig = render_floor_area_figure(setup_name)
-    energy_fig = render_energy_figure(setup_name)
+    floor_area_fig = cached_layout('floor_area_layout', setup_name, render_floor_area_figure)
+    energy_fig = cached_layout('energy_layout', setup_name, render_energy_figure)
     return floor_area_fig, energy_fig
 
 
@@ -689,7 +987,7 @@ def floor_area_layout(setup_name):
     State('visualize-setup-dropdown', 'value')
 )
 def floor_area_figure(sid, setup_name):
-    return create_floor_area_figure(setup_name, sid)
+    return cached_layout('floor_area_figure', setup_name, create_floor_area_figure, sid)
 
 
 @app.callback(
@@ -698,7 +996,8 @@ def floor_area_figure(sid, setup_name):
     State('visualize-setup-dropdown', 'value')
 )
 def energy_figure(enduses, setup_name):
-    return create_energy_figure(setup_name, enduses)
+    return cached_layout('energy_figure', setup_name,
+                         lambda setup, uses: create_energy_figure(setup, list(uses)), tuple(enduses))
 
 
 if __name__ == '__main__':